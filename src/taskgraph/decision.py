@@ -163,10 +163,7 @@ def get_decision_parameters(graph_config, options):
 
     repo_path = os.getcwd()
     repo = get_repository(repo_path)
-    try:
-        commit_message = repo.get_commit_message()
-    except UnicodeDecodeError:
-        commit_message = ""
+    commit_message = repo.get_commit_message()
 
     parameters["base_ref"] = _determine_more_accurate_base_ref(
         repo,
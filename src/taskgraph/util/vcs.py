@@ -3,22 +3,251 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
+import configparser
+import functools
+import hashlib
+import json
 import logging
 import os
+import random
 import re
+import struct
 import subprocess
+import tempfile
+import threading
+import time
 from abc import ABC, abstractmethod, abstractproperty
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from shutil import which
 
+import appdirs
 import requests
-from redo import retry
 
+from taskgraph.util.memoize import memoize
 from taskgraph.util.path import ancestors
 
 PUSHLOG_TMPL = "{}/json-pushes?version=2&changeset={}&tipsonly=1&full=1"
+# Maximum number of revisions to look up in a single pushlog query.
+PUSHLOG_BATCH_SIZE = 50
+
+# Only full hashes are guaranteed to always refer to the same push.
+_FULL_REVISION_RE = re.compile(r"[0-9a-fA-F]{40}")
+# Revisions that can be matched against the changesets of a push. Shorter
+# ones may as well be revision numbers.
+_REVISION_PREFIX_RE = re.compile(r"[0-9a-fA-F]{12,40}")
 
 logger = logging.getLogger(__name__)
 
+try:
+    from functools import cached_property
+except ImportError:
+    # Python 3.7
+
+    class cached_property:
+        def __init__(self, func):
+            self.func = func
+            self.attrname = func.__name__
+            self.__doc__ = func.__doc__
+
+        def __get__(self, instance, owner=None):
+            if instance is None:
+                return self
+            value = instance.__dict__[self.attrname] = self.func(instance)
+            return value
+
+
+@memoize
+def _which(tool, search_path):
+    # Looking up a binary stats candidates in every directory of the search
+    # path, so only do it once per tool and search path.
+    return which(tool, path=search_path)
+
+
+# Maximum number of method results `_instance_cache` keeps per instance.
+_INSTANCE_CACHE_SIZE = 32
+
+
+def _instance_cache(func):
+    """Memoize the results of a method in the instance it is called on.
+
+    Unlike `taskgraph.util.memoize.memoize`, keyword arguments are
+    supported. Only the ``_INSTANCE_CACHE_SIZE`` most recently used results
+    are kept, as repositories may live as long as the process. Cached values
+    are dropped by `Repository.invalidate`.
+    """
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        cache = self.__dict__.setdefault("_method_cache", OrderedDict())
+        try:
+            cache.move_to_end(key)
+            return cache[key]
+        except KeyError:
+            pass
+
+        value = cache[key] = func(self, *args, **kwargs)
+        if len(cache) > _INSTANCE_CACHE_SIZE:
+            cache.popitem(last=False)
+        return value
+
+    wrapper.instance_cached = True
+    return wrapper
+
+
+class _BatchSession:
+    """A long-running ``git cat-file --batch`` process.
+
+    Object names are written to the process' stdin and the matching objects
+    are read back from its stdout, so looking up many objects only costs a
+    single ``git`` process.
+    """
+
+    FORMAT = "%(objectname) %(objecttype) %(objectsize)"
+
+    def __init__(self, binary, path, env=None):
+        self._cmd = (binary, "cat-file", f"--batch={self.FORMAT}")
+        self._lock = threading.Lock()
+        self._proc = subprocess.Popen(
+            self._cmd,
+            cwd=path,
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def get_object(self, name):
+        """Return a ``(sha, type, contents)`` tuple for the object ``name``."""
+        with self._lock:
+            return self._get_object(name)
+
+    def _get_object(self, name):
+        if "\n" in name:
+            # Names are delimited by newlines, so this would send several
+            # queries and leave replies unread for the next lookups.
+            raise subprocess.CalledProcessError(
+                128, self._cmd + (name,), output=f"{name} missing"
+            )
+
+        self._proc.stdin.write(name.encode("utf-8") + b"\n")
+        self._proc.stdin.flush()
+
+        header = self._proc.stdout.readline()
+        if not header:
+            raise RuntimeError(f"{self._cmd} exited unexpectedly")
+
+        # Git replies with "<name> missing" or "<name> ambiguous", where the
+        # name may contain spaces.
+        if header.rsplit(None, 1)[-1] in (b"missing", b"ambiguous"):
+            raise subprocess.CalledProcessError(
+                128, self._cmd + (name,), output=header.decode("utf-8", "replace")
+            )
+
+        sha, object_type, size = header.split()
+        # Contents are followed by a single LF.
+        contents = self._proc.stdout.read(int(size) + 1)[:-1]
+        return sha.decode("ascii"), object_type.decode("ascii"), contents
+
+    def close(self):
+        if self._proc.poll() is None:
+            self._proc.stdin.close()
+            self._proc.wait()
+        self._proc.stdout.close()
+
+
+class _HgCommandServer:
+    """A long-running ``hg serve --cmdserver pipe`` process.
+
+    Commands are framed according to the Mercurial command server protocol,
+    which avoids paying Mercurial's startup cost on every invocation.
+
+    https://www.mercurial-scm.org/wiki/CommandServer
+    """
+
+    def __init__(self, binary, path, env=None):
+        self._binary = binary
+        self._lock = threading.Lock()
+        self._proc = subprocess.Popen(
+            (
+                binary,
+                "serve",
+                "--cmdserver",
+                "pipe",
+                "--config",
+                "ui.interactive=False",
+            ),
+            cwd=path,
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+        # The server starts by announcing its capabilities.
+        channel, hello = self._read_message()
+        if channel != b"o" or b"runcommand" not in hello:
+            self.close()
+            raise RuntimeError(f"Unexpected hello from the hg command server: {hello}")
+
+    def _read_message(self):
+        header = self._proc.stdout.read(5)
+        if len(header) != 5:
+            raise RuntimeError("hg command server exited unexpectedly")
+
+        channel, length = struct.unpack(">cI", header)
+        if channel in (b"I", b"L"):
+            # Input requests carry the requested size rather than a payload.
+            return channel, length
+        return channel, self._proc.stdout.read(length)
+
+    def runcommand(self, *args):
+        """Run ``hg`` with ``args`` and return its output as bytes.
+
+        Raise ``subprocess.CalledProcessError`` on non-zero return codes, like
+        ``subprocess.check_output`` does.
+        """
+        with self._lock:
+            return self._runcommand(*args)
+
+    def _runcommand(self, *args):
+        data = b"\0".join(arg.encode("utf-8") for arg in args)
+        self._proc.stdin.write(b"runcommand\n" + struct.pack(">I", len(data)) + data)
+        self._proc.stdin.flush()
+
+        output = []
+        error = []
+        while True:
+            channel, payload = self._read_message()
+            if channel == b"o":
+                output.append(payload)
+            elif channel == b"e":
+                error.append(payload)
+            elif channel == b"r":
+                returncode = struct.unpack(">i", payload)[0]
+                break
+            elif channel in (b"I", b"L"):
+                # We never provide any input.
+                self._proc.stdin.write(struct.pack(">I", 0))
+                self._proc.stdin.flush()
+            elif channel.isupper():
+                raise RuntimeError(f"Unsupported hg command server channel: {channel}")
+            # Other lowercase channels are optional and can be ignored.
+
+        if returncode:
+            raise subprocess.CalledProcessError(
+                returncode,
+                (self._binary,) + args,
+                output=b"".join(output),
+                stderr=b"".join(error),
+            )
+        return b"".join(output)
+
+    def close(self):
+        if self._proc.poll() is None:
+            self._proc.stdin.close()
+            self._proc.wait()
+        self._proc.stdout.close()
+
 
 class Repository(ABC):
     # Both mercurial and git use sha1 as revision idenfiers. Luckily, both define
@@ -28,28 +257,129 @@ class Repository(ABC):
     # https://www.mercurial-scm.org/repo/hg-stable/file/82efc31bd152/mercurial/node.py#l30
     NULL_REVISION = "0000000000000000000000000000000000000000"
 
+    # Helper process kept alive to answer read-only queries, see
+    # `_get_session`, and the id of the process that started it.
+    _session = None
+    _session_pid = None
+
+    # Cached values some properties are computed from, see `prefetch`.
+    _prefetch_dependencies = {}
+
     def __init__(self, path):
         self.path = path
-        self.binary = which(self.tool)
+        self.binary = _which(self.tool, os.environ.get("PATH"))
         if self.binary is None:
             raise OSError(f"{self.tool} not found!")
         self._valid_diff_filter = ("m", "a", "d")
 
-        self._env = os.environ.copy()
+        # Environment of the VCS commands. `None` inherits the environment
+        # of the current process without copying it.
+        self._env = None
+        self._session_lock = threading.Lock()
 
     def run(self, *args: str, **kwargs):
+        """Run the VCS binary with ``args`` and return its output.
+
+        Output is decoded as UTF-8 by default. Pass ``encoding=None`` to get
+        bytes instead, e.g. when only part of a large output is needed.
+        """
         return_codes = kwargs.pop("return_codes", [])
+        kwargs.setdefault("encoding", "utf-8")
         cmd = (self.binary,) + args
 
         try:
-            return subprocess.check_output(
-                cmd, cwd=self.path, env=self._env, encoding="utf-8", **kwargs
-            )
+            return subprocess.check_output(cmd, cwd=self.path, env=self._env, **kwargs)
         except subprocess.CalledProcessError as e:
             if e.returncode in return_codes:
-                return ""
+                return "" if kwargs["encoding"] else b""
             raise
 
+    def _create_session(self):
+        """Start the helper process used to answer read-only queries.
+
+        Return None if the repository doesn't use any.
+        """
+        return None
+
+    def _get_session(self):
+        with self._session_lock:
+            # Repositories are cached by `get_repository`, so they may be
+            # inherited by forked processes. Those can't share the pipes to
+            # the helper process with their parent and need their own.
+            if self._session is None or self._session_pid != os.getpid():
+                self._session = self._create_session()
+                self._session_pid = os.getpid()
+        return self._session
+
+    def close(self, _getpid=os.getpid):
+        """Terminate the helper process, if any was started."""
+        # `_getpid` is bound early, as this may be called from `__del__`
+        # when the `os` module was already torn down at exit.
+        if self._session is not None and self._session_pid == _getpid():
+            self._session.close()
+        self._session = None
+
+    def prefetch(self, *names):
+        """Compute the cached properties or methods ``names`` concurrently.
+
+        Methods are called without arguments. Values several of them are
+        computed from are computed first, then the read-only commands behind
+        the others run in parallel. Later accesses are served from the
+        cache. Errors are not raised here, but again on access.
+        """
+        for name in names:
+            attr = getattr(type(self), name, None)
+            if not (
+                isinstance(attr, cached_property)
+                or getattr(attr, "instance_cached", False)
+            ):
+                raise ValueError(f"{name} can't be prefetched")
+
+        def compute(name):
+            value = getattr(self, name)
+            if not isinstance(getattr(type(self), name), cached_property):
+                value()
+
+        dependencies = dict.fromkeys(
+            dependency
+            for name in names
+            for dependency in self._prefetch_dependencies.get(name, ())
+        )
+        for name in dependencies:
+            try:
+                compute(name)
+            except Exception as e:
+                logger.debug(f"Failed to prefetch {name}: {e}")
+
+        names = [name for name in names if name not in self.__dict__]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = {name: executor.submit(compute, name) for name in names}
+        for name, future in futures.items():
+            if future.exception() is not None:
+                logger.debug(f"Failed to prefetch {name}: {future.exception()}")
+
+    def invalidate(self):
+        """Forget cached values, so they get recomputed on next access.
+
+        Values such as `head_rev` or `branch` are only computed once per
+        instance. This must be called after the working directory was
+        changed by means other than `update`.
+        """
+        for cls in type(self).__mro__:
+            for name, value in vars(cls).items():
+                if isinstance(value, cached_property):
+                    self.__dict__.pop(name, None)
+        self.__dict__.pop("_method_cache", None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
     @abstractproperty
     def tool(self) -> str:
         """Version control system being used, either 'hg' or 'git'."""
@@ -110,6 +440,11 @@ class Repository(ABC):
     def get_commit_message(self, revision=None):
         """Commit message of specified revision or current commit."""
 
+    def get_commit_subject(self, revision=None):
+        """First line of the commit message of specified revision or current
+        commit."""
+        return self.get_commit_message(revision).split("\n", 1)[0]
+
     @abstractmethod
     def get_changed_files(self, diff_filter, mode="unstaged", rev=None, base_rev=None):
         """Return a list of files that are changed in:
@@ -157,6 +492,11 @@ class Repository(ABC):
         By default, untracked and ignored files are not considered. If
         ``untracked`` or ``ignored`` are set, they influence the clean check
         to factor these file classes into consideration.
+
+        The result isn't cached: files may have been modified since the last
+        call, which is precisely what callers want to check. Neither
+        .hg/dirstate nor .git/index can serve as a cache key either, as
+        editing a tracked file doesn't touch them.
         """
 
     @abstractmethod
@@ -182,17 +522,56 @@ class HgRepository(Repository):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._env["HGPLAIN"] = "1"
+        self._env = {**os.environ, "HGPLAIN": "1"}
 
-    @property
+    def _create_session(self):
+        return _HgCommandServer(self.binary, self.path, env=self._env)
+
+    def _query_node(self, *args):
+        """Run a read-only command outputting a changeset hash through the
+        command server.
+
+        The server only reads the repository configuration once, so commands
+        depending on it (e.g. ``paths``) must go through `run` instead.
+        """
+        return self._get_session().runcommand(*args).strip().decode("ascii")
+
+    @cached_property
     def head_rev(self):
-        return self.run("log", "-r", ".", "-T", "{node}").strip()
+        # Like `branch`, read the working directory parent from the dirstate
+        # directly rather than running hg. Both the v1 format and the v2
+        # docket (after its marker) start with the parent nodes.
+        dirstate_fn = os.path.join(self.path, ".hg", "dirstate")
+        try:
+            with open(dirstate_fn, "rb") as f:
+                data = f.read(32)
+        except OSError:
+            data = b""
 
-    @property
+        v2_marker = b"dirstate-v2\n"
+        if data.startswith(v2_marker):
+            data = data[len(v2_marker) :]
+        if len(data) >= 20:
+            return data[:20].hex()
+
+        return self._query_node("log", "-r", ".", "-T", "{node}")
+
+    @cached_property
     def base_rev(self):
-        return self.run("log", "-r", "last(ancestors(.) and public())", "-T", "{node}")
+        # Public changesets are closed under ancestry, so the closest public
+        # ancestor is either `.` itself, or a parent of a non-public
+        # ancestor. Starting from the (usually few) non-public changesets
+        # avoids walking the whole history like `last(ancestors(.) and
+        # public())` would.
+        return self._query_node(
+            "log",
+            "-r",
+            "max((. + parents((draft() or secret()) and ::.)) and public())",
+            "-T",
+            "{node}",
+        )
 
-    @property
+    @cached_property
     def branch(self):
         bookmarks_fn = os.path.join(self.path, ".hg", "bookmarks.current")
         if os.path.exists(bookmarks_fn):
@@ -202,6 +581,28 @@ class HgRepository(Repository):
 
         return None
 
+    def _get_remote_names_from_hgrc(self):
+        """Read the remote names defined in the repository's hgrc.
+
+        Remotes defined in the user or system configuration are not
+        included. Return an empty list if the file can't be parsed, e.g.
+        because it uses `%include`.
+        """
+        parser = configparser.ConfigParser(
+            delimiters=("=",), interpolation=None, strict=False
+        )
+        # Names are case sensitive.
+        parser.optionxform = str
+        try:
+            parser.read(os.path.join(self.path, ".hg", "hgrc"))
+        except configparser.Error:
+            return []
+
+        if not parser.has_section("paths"):
+            return []
+        # Skip sub-options such as `default:pushurl`.
+        return [name for name in parser["paths"] if ":" not in name]
+
     @property
     def all_remote_names(self):
         remotes = self.run("paths", "--quiet").splitlines()
@@ -209,24 +610,42 @@ class HgRepository(Repository):
             raise RuntimeError("No remotes defined")
         return remotes
 
-    @property
+    @cached_property
     def remote_name(self):
+        # The default remote is preferred over any other, so when the
+        # repository's hgrc defines it, there's no need to run hg to list the
+        # remotes merged from the user and system configuration.
+        if self.default_remote_name in self._get_remote_names_from_hgrc():
+            return self.default_remote_name
+
         return self._get_most_suitable_remote(
             "Edit .hg/hgrc and add:\n\n[paths]\ndefault = $URL",
         )
 
-    @property
+    @cached_property
     def default_branch(self):
         # Mercurial recommends keeping "default"
         # https://www.mercurial-scm.org/wiki/StandardBranching#Don.27t_use_a_name_other_than_default_for_your_main_development_branch
         return "default"
 
+    @_instance_cache
     def get_url(self, remote="default"):
         return self.run("path", "-T", "{url}", remote).strip()
 
+    @_instance_cache
     def get_commit_message(self, revision=None):
         revision = revision or "."
-        return self.run("log", "-r", revision, "-T", "{desc}")
+        # Messages may not be valid UTF-8 in old repositories.
+        output = self._get_session().runcommand("log", "-r", revision, "-T", "{desc}")
+        return output.decode("utf-8", "replace")
+
+    @_instance_cache
+    def get_commit_subject(self, revision=None):
+        revision = revision or "."
+        output = self._get_session().runcommand(
+            "log", "-r", revision, "-T", "{desc|firstline}"
+        )
+        return output.decode("utf-8", "replace")
 
     def _format_diff_filter(self, diff_filter, for_status=False):
         df = diff_filter.lower()
@@ -293,10 +712,13 @@ class HgRepository(Repository):
         return not len(self.run(*args).strip())
 
     def update(self, ref):
-        return self.run("update", "--check", ref)
+        try:
+            return self.run("update", "--check", ref)
+        finally:
+            self.invalidate()
 
     def find_latest_common_revision(self, base_ref_or_rev, head_rev):
-        return self.run(
+        return self._query_node(
             "log",
             "-r",
             f"last(ancestors('{base_ref_or_rev}') and ancestors('{head_rev}'))",
@@ -319,24 +741,94 @@ class GitRepository(Repository):
     tool = "git"
     default_remote_name = "origin"
 
-    _LS_REMOTE_PATTERN = re.compile(r"ref:\s+refs/heads/(?P<branch_name>\S+)\s+HEAD")
+    _LS_REMOTE_PATTERN = re.compile(r"ref:\s+refs/heads/(?P<branch_name>\S+)\s+HEAD\b")
 
-    @property
+    _prefetch_dependencies = {
+        "head_rev": ("_rev_parse_bundle",),
+        "branch": ("_rev_parse_bundle",),
+        "remote_name": ("_rev_parse_bundle",),
+        "default_branch": ("_rev_parse_bundle", "remote_name"),
+    }
+
+    def _create_session(self):
+        return _BatchSession(self.binary, self.path, env=self._env)
+
+    def _get_commit(self, revision):
+        """Return the sha and raw contents of the commit ``revision``."""
+        sha, _, contents = self._get_session().get_object(f"{revision}^{{commit}}")
+        return sha, contents
+
+    @cached_property
+    def _rev_parse_bundle(self):
+        """Resolve HEAD, the current branch and its upstream in a single call.
+
+        Return a ``(head_rev, branch, upstream)`` tuple. Values git could not
+        resolve are None: ``branch`` on a detached HEAD, ``upstream`` when no
+        upstream branch is configured and all of them when there is no
+        commit yet.
+        """
+        try:
+            output = self.run(
+                "rev-parse",
+                "HEAD",
+                # Unlike `--abbrev-ref`, this doesn't prefix the branch name
+                # with `heads/` when a tag has the same name.
+                "--symbolic-full-name",
+                "HEAD",
+                "--abbrev-ref",
+                "@{u}",
+                stderr=subprocess.DEVNULL,
+            )
+        except subprocess.CalledProcessError as e:
+            # Error code 128 comes with messages like:
+            # "fatal: no upstream configured for branch $BRANCH"
+            # Git stops at the first name it cannot resolve, but still outputs
+            # the ones before it.
+            if e.returncode != 128:
+                raise
+            output = e.output
+
+        head_rev, branch, upstream = (output.splitlines() + [None] * 3)[:3]
+        if head_rev is None or not _FULL_REVISION_RE.fullmatch(head_rev):
+            # Without `--verify`, names that can't be resolved are echoed
+            # as is, e.g. `HEAD` on a branch without any commit.
+            return None, None, None
+        branch_prefix = "refs/heads/"
+        if branch is not None and branch.startswith(branch_prefix):
+            branch = branch[len(branch_prefix) :]
+        else:
+            # A detached HEAD is output as `HEAD`.
+            branch = None
+        return head_rev, branch, upstream
+
+    @cached_property
     def head_rev(self):
-        return self.run("rev-parse", "--verify", "HEAD").strip()
+        return self._rev_parse_bundle[0] or self._get_commit("HEAD")[0]
 
-    @property
+    @cached_property
     def base_rev(self):
+        # Without remotes, this lists the whole history, but only the last
+        # line matters. Don't bother decoding the rest.
         refs = self.run(
-            "rev-list", "HEAD", "--topo-order", "--boundary", "--not", "--remotes"
+            "rev-list",
+            "HEAD",
+            "--topo-order",
+            "--boundary",
+            "--not",
+            "--remotes",
+            encoding=None,
         ).splitlines()
         if refs:
-            return refs[-1][1:]  # boundary starts with a prefix `-`
+            return refs[-1][1:].decode("ascii")  # boundary starts with a prefix `-`
         return self.head_rev
 
-    @property
+    @cached_property
     def branch(self):
-        return self.run("branch", "--show-current").strip() or None
+        head_rev, branch, _ = self._rev_parse_bundle
+        if head_rev is None:
+            # `rev-parse` can't resolve branches without any commit.
+            return self.run("branch", "--show-current").strip() or None
+        return branch
 
     @property
     def all_remote_names(self):
@@ -345,22 +837,15 @@ class GitRepository(Repository):
             raise RuntimeError("No remotes defined")
         return remotes
 
-    @property
+    @cached_property
     def remote_name(self):
-        try:
-            remote_branch_name = self.run(
-                "rev-parse", "--verify", "--abbrev-ref", "--symbolic-full-name", "@{u}"
-            ).strip()
+        remote_branch_name = self._rev_parse_bundle[2]
+        if remote_branch_name:
             return remote_branch_name.split("/")[0]
-        except subprocess.CalledProcessError as e:
-            # Error code 128 comes with the message:
-            # "fatal: no upstream configured for branch $BRANCH"
-            if e.returncode != 128:
-                raise
 
         return self._get_most_suitable_remote("`git remote add origin $URL`")
 
-    @property
+    @cached_property
     def default_branch(self):
         try:
             # this one works if the current repo was cloned from an existing
@@ -382,8 +867,21 @@ class GitRepository(Repository):
     def _get_default_branch_from_remote_query(self):
         # This function requires network access to the repo
         remote_name = self.remote_name
-        output = self.run("ls-remote", "--symref", remote_name, "HEAD")
-        matches = self._LS_REMOTE_PATTERN.search(output)
+        # Protocol v2 lets the server only advertise refs matching "HEAD",
+        # whereas v0 and v1 always advertise every ref of the repository.
+        # Request it explicitly in case it isn't the default for this git
+        # version or was overridden by the user's configuration.
+        output = self.run(
+            "-c", "protocol.version=2", "ls-remote", "--symref", remote_name, "HEAD"
+        )
+        # The symbolic ref is normally the first line of the output, so only
+        # look further if the server sent something else first.
+        matches = None
+        first_line = output.split("\n", 1)[0]
+        if first_line.startswith("ref: refs/heads/"):
+            matches = self._LS_REMOTE_PATTERN.match(first_line)
+        if not matches:
+            matches = self._LS_REMOTE_PATTERN.search(output)
         if not matches:
             raise RuntimeError(
                 f'Could not find the default branch of remote repository "{remote_name}". '
@@ -394,7 +892,23 @@ class GitRepository(Repository):
         return f"{remote_name}/{branch_name}"
 
     def _get_default_branch_from_cloned_metadata(self):
-        return self.run("rev-parse", "--abbrev-ref", f"{self.remote_name}/HEAD").strip()
+        remote_name = self.remote_name
+
+        # `git clone` records the remote default branch as a loose symbolic
+        # ref. Read it directly when possible rather than spawning git.
+        symref_path = os.path.join(
+            self.path, ".git", "refs", "remotes", remote_name, "HEAD"
+        )
+        symref_prefix = "ref: refs/remotes/"
+        try:
+            with open(symref_path) as f:
+                symref = f.read().strip()
+            if symref.startswith(symref_prefix):
+                return symref[len(symref_prefix) :]
+        except OSError:
+            pass
+
+        return self.run("rev-parse", "--abbrev-ref", f"{remote_name}/HEAD").strip()
 
     def _guess_default_branch(self):
         branches = [
@@ -411,12 +925,28 @@ class GitRepository(Repository):
 
         raise RuntimeError(f"Unable to find default branch. Got: {branches}")
 
+    @_instance_cache
     def get_url(self, remote="origin"):
         return self.run("remote", "get-url", remote).strip()
 
+    @_instance_cache
     def get_commit_message(self, revision=None):
         revision = revision or "HEAD"
-        return self.run("log", "-n1", "--format=%B", revision)
+        _, contents = self._get_commit(revision)
+
+        # Commit objects are a list of headers followed by an empty line and
+        # the message itself.
+        headers, _, message = contents.partition(b"\n\n")
+        encoding = "utf-8"
+        for header in headers.splitlines():
+            if header.startswith(b"encoding "):
+                encoding = header[len(b"encoding ") :].decode("ascii")
+
+        # Messages may not be valid in their declared encoding.
+        try:
+            return message.decode(encoding, "replace")
+        except LookupError:
+            return message.decode("utf-8", "replace")
 
     def get_changed_files(
         self, diff_filter="ADM", mode="unstaged", rev=None, base_rev=None
@@ -479,17 +1009,20 @@ class GitRepository(Repository):
         return not len(self.run(*args).strip())
 
     def update(self, ref):
-        self.run("checkout", ref)
+        try:
+            self.run("checkout", ref)
+        finally:
+            self.invalidate()
 
     def find_latest_common_revision(self, base_ref_or_rev, head_rev):
-        return self.run("merge-base", base_ref_or_rev, head_rev).strip()
+        output = self.run("merge-base", base_ref_or_rev, head_rev, encoding=None)
+        return output.strip().decode("ascii")
 
     def does_revision_exist_locally(self, revision):
         try:
-            return self.run("cat-file", "-t", revision).strip() == "commit"
+            return self._get_session().get_object(revision)[1] == "commit"
         except subprocess.CalledProcessError as e:
-            # Error code 128 comes with the message:
-            # "git cat-file: could not get object info"
+            # Error code 128 is raised when the object is missing
             if e.returncode == 128:
                 return False
             raise
@@ -498,7 +1031,22 @@ class GitRepository(Repository):
 def get_repository(path):
     """Get a repository object for the repository at `path`.
     If `path` is not a known VCS repository, raise an exception.
+
+    Repository objects are cached, so that properties they already computed
+    can be reused by other callers. Use ``get_repository.cache_clear()`` to
+    reset the cache.
     """
+    return _get_repository(os.path.realpath(path))
+
+
+# Cached repositories may keep a helper process alive, so bound the cache.
+@functools.lru_cache(maxsize=16)
+def _get_repository(path):
+    # This walk is deliberately not delegated to `git rev-parse
+    # --show-toplevel` or `hg root`: their own discovery stats at least as
+    # many paths per directory level, on top of the cost of spawning a
+    # process. It also lets a hg repository nested in a git working copy
+    # (or vice versa) take precedence, as the closest one should.
     for path in ancestors(path):
         if os.path.isdir(os.path.join(path, ".hg")):
             return HgRepository(path)
@@ -508,32 +1056,179 @@ def get_repository(path):
     raise RuntimeError("Current directory is neither a git or hg repository")
 
 
-def find_hg_revision_push_info(repository, revision):
-    """Given the parameters for this action and a revision, find the
-    pushlog_id of the revision."""
-    pushlog_url = PUSHLOG_TMPL.format(repository, revision)
-
-    def query_pushlog(url):
-        r = requests.get(pushlog_url, timeout=60)
-        r.raise_for_status()
-        return r
-
-    r = retry(
-        query_pushlog,
-        args=(pushlog_url,),
-        attempts=5,
-        sleeptime=10,
+get_repository.cache_clear = _get_repository.cache_clear
+
+
+@memoize
+def _get_pushlog_session():
+    # Reuse connections across queries and retries. Retries are handled by
+    # the caller.
+    session = requests.Session()
+    http_adapter = requests.adapters.HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=0,
     )
-    pushes = r.json()["pushes"]
-    if len(pushes) != 1:
-        raise RuntimeError(
-            "Unable to find a single pushlog_id for {} revision {}: {}".format(
-                repository, revision, pushes
-            )
-        )
-    pushid = list(pushes.keys())[0]
+    session.mount("http://", http_adapter)
+    session.mount("https://", http_adapter)
+    return session
+
+
+def _pushlog_cache_dir():
+    return os.path.join(appdirs.user_cache_dir("taskgraph"), "pushlog")
+
+
+def _pushlog_cache_path(pushlog_url):
+    digest = hashlib.blake2b(pushlog_url.encode("utf-8"), digest_size=16)
+    return os.path.join(_pushlog_cache_dir(), f"{digest.hexdigest()}.json")
+
+
+def _read_pushlog_cache(path):
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_pushlog_cache(path, push_info):
+    # Write to a temporary file first so concurrent readers never see a
+    # partially written entry.
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=os.path.dirname(path), suffix=".tmp", delete=False
+        ) as fh:
+            json.dump(push_info, fh)
+        os.replace(fh.name, path)
+    except OSError as e:
+        logger.debug(f"Unable to cache pushlog info in {path}: {e}")
+
+
+def _query_pushlog(url, attempts=5):
+    for attempt in range(attempts):
+        try:
+            r = _get_pushlog_session().get(url, timeout=60)
+            r.raise_for_status()
+            return r
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+            # Client errors won't go away by retrying, except when rate limited
+            # or when the revision hasn't been replicated to the server yet.
+            status = e.response.status_code if e.response is not None else None
+            if attempt == attempts - 1 or (
+                status is not None and 400 <= status < 500 and status not in (404, 429)
+            ):
+                raise
+
+            if status == 404:
+                # Replication can take over a minute, so wait as long as the
+                # previous fixed schedule did (10s, growing by 1.5x each time).
+                sleeptime = 10 * 1.5**attempt
+            else:
+                sleeptime = min(30, 0.5 * 2**attempt)
+            sleeptime += random.uniform(0, 0.25)
+            logger.info(f"Querying {url} failed ({e}), retrying in {sleeptime:.1f}s")
+            time.sleep(sleeptime)
+
+
+def _get_push_info(pushes, pushid):
     return {
         "pushdate": pushes[pushid]["date"],
         "pushid": pushid,
         "user": pushes[pushid]["user"],
     }
+
+
+def _query_push_info(repository, revisions):
+    if len(revisions) == 1:
+        revision = revisions[0]
+        r = _query_pushlog(PUSHLOG_TMPL.format(repository, revision))
+        pushes = r.json()["pushes"]
+        if len(pushes) != 1:
+            raise RuntimeError(
+                "Unable to find a single pushlog_id for {} revision {}: {}".format(
+                    repository, revision, pushes
+                )
+            )
+        return {revision: _get_push_info(pushes, list(pushes.keys())[0])}
+
+    # Only the tip of each push would be listed with `tipsonly=1`, whereas
+    # all the changesets are needed to tell which push contains which
+    # revision.
+    query = "&".join(f"changeset={revision}" for revision in revisions)
+    r = _query_pushlog(f"{repository}/json-pushes?version=2&{query}")
+    pushes = r.json()["pushes"]
+
+    push_infos = {}
+    for revision in revisions:
+        pushids = [
+            pushid
+            for pushid, push in pushes.items()
+            if any(node.startswith(revision.lower()) for node in push["changesets"])
+        ]
+        if len(pushids) != 1:
+            raise RuntimeError(
+                "Unable to find a single pushlog_id for {} revision {}: {}".format(
+                    repository, revision, pushids
+                )
+            )
+        push_infos[revision] = _get_push_info(pushes, pushids[0])
+    return push_infos
+
+
+def find_hg_revision_push_info_batch(repository, revisions):
+    """Given a repository and a list of revisions, find the push info of each
+    revision.
+
+    Returns a dict mapping each revision to the push info, as returned by
+    `find_hg_revision_push_info`. The pushlog is queried for up to
+    ``PUSHLOG_BATCH_SIZE`` revisions at once. Only revisions given as
+    hashes of at least 12 characters can be batched: others, such as tags
+    or bookmarks, are looked up one at a time.
+
+    Pushes never change once they exist, so results for full revision hashes
+    are cached on disk. Set ``TASKGRAPH_DISABLE_PUSHLOG_CACHE`` in the
+    environment to disable this cache.
+    """
+    use_cache = not os.environ.get("TASKGRAPH_DISABLE_PUSHLOG_CACHE")
+
+    push_infos = {}
+    missing = []
+    for revision in dict.fromkeys(revisions):
+        if use_cache and _FULL_REVISION_RE.fullmatch(revision):
+            cache_path = _pushlog_cache_path(PUSHLOG_TMPL.format(repository, revision))
+            push_info = _read_pushlog_cache(cache_path)
+            if push_info is not None:
+                push_infos[revision] = push_info
+                continue
+        missing.append(revision)
+
+    hashes = []
+    chunks = []
+    for revision in missing:
+        if _REVISION_PREFIX_RE.fullmatch(revision):
+            hashes.append(revision)
+        else:
+            chunks.append([revision])
+    for i in range(0, len(hashes), PUSHLOG_BATCH_SIZE):
+        chunks.append(hashes[i : i + PUSHLOG_BATCH_SIZE])
+
+    for chunk in chunks:
+        for revision, push_info in _query_push_info(repository, chunk).items():
+            if use_cache and _FULL_REVISION_RE.fullmatch(revision):
+                cache_path = _pushlog_cache_path(
+                    PUSHLOG_TMPL.format(repository, revision)
+                )
+                _write_pushlog_cache(cache_path, push_info)
+            push_infos[revision] = push_info
+
+    return push_infos
+
+
+def find_hg_revision_push_info(repository, revision):
+    """Given the parameters for this action and a revision, find the
+    pushlog_id of the revision.
+
+    See `find_hg_revision_push_info_batch` to look up many revisions.
+    """
+    return find_hg_revision_push_info_batch(repository, [revision])[revision]
@@ -4,11 +4,21 @@
 
 import os
 import subprocess
+import threading
+import time
 from textwrap import dedent
 
 import pytest
-
-from taskgraph.util.vcs import HgRepository, Repository, get_repository
+import requests
+
+from taskgraph.util.vcs import (
+    GitRepository,
+    HgRepository,
+    Repository,
+    find_hg_revision_push_info,
+    find_hg_revision_push_info_batch,
+    get_repository,
+)
 
 from .fixtures.vcs import create_remote_repo
 
@@ -29,6 +39,14 @@ def test_get_repository(repo):
         os.rmdir(new_dir)
 
 
+def test_get_repository_cached(repo):
+    assert get_repository(repo.path) is repo
+    assert get_repository(os.path.join(repo.path, ".")) is repo
+
+    get_repository.cache_clear()
+    assert get_repository(repo.path) is not repo
+
+
 def test_get_repository_type(repo):
     if isinstance(repo, HgRepository):
         assert repo.tool == "hg"
@@ -41,6 +59,20 @@ def test_get_repository_type_failure(tmpdir):
         get_repository(tmpdir.strpath)
 
 
+def test_binary_lookup_cached(mocker, git_repo):
+    which = mocker.patch("taskgraph.util.vcs.which", return_value="/bin/fakegit")
+    mocker.patch.dict(os.environ, {"PATH": "/some/unique/path"})
+
+    assert GitRepository(git_repo).binary == "/bin/fakegit"
+    assert GitRepository(git_repo).binary == "/bin/fakegit"
+    which.assert_called_once_with("git", path="/some/unique/path")
+
+
+def test_run_bytes(repo):
+    assert isinstance(repo.run("status"), str)
+    assert isinstance(repo.run("status", encoding=None), bytes)
+
+
 def test_hgplain(monkeypatch, hg_repo):
     repo = get_repository(hg_repo)
 
@@ -54,6 +86,18 @@ def test_hgplain(monkeypatch, hg_repo):
     assert kwargs["env"]["HGPLAIN"] == "1"
 
 
+def test_git_env_inherited(monkeypatch, git_repo):
+    repo = GitRepository(git_repo)
+
+    def fake_check_output(*args, **kwargs):
+        return args, kwargs
+
+    monkeypatch.setattr(subprocess, "check_output", fake_check_output)
+
+    _, kwargs = repo.run("log")
+    assert kwargs["env"] is None
+
+
 @pytest.mark.parametrize(
     "commit_message",
     (
@@ -76,6 +120,148 @@ def test_get_commit_message(repo, commit_message):
     assert repo.get_commit_message().strip() == commit_message
 
 
+def test_get_commit_subject(repo):
+    some_file_path = os.path.join(repo.path, "some_file")
+    with open(some_file_path, "w") as f:
+        f.write("some data")
+
+    repo.run("add", some_file_path)
+    repo.run("commit", "-m", "Subject line\n\nAnd a body.")
+    assert repo.get_commit_subject() == "Subject line"
+
+
+def test_session_reused(repo):
+    first_message = repo.get_commit_message()
+    session = repo._session
+    assert session is not None
+
+    bar = os.path.join(repo.path, "bar")
+    with open(bar, "w") as fh:
+        fh.write("bar")
+    repo.run("add", bar)
+    repo.run("commit", "-m", "Second commit")
+    repo.invalidate()
+
+    assert repo.get_commit_message().strip() == "Second commit"
+    assert repo.get_commit_message(repo.head_rev).strip() == "Second commit"
+    assert repo._session is session
+
+    repo.close()
+    assert repo._session is None
+    assert session._proc.stdout.closed
+    assert repo.get_commit_message().strip() != first_message.strip()
+
+
+def test_session_after_fork(repo):
+    message = repo.get_commit_message()
+    session = repo._session
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            repo.invalidate()
+            forked = repo.get_commit_message() == message
+            forked = forked and repo._session is not session
+            repo.close()
+        except BaseException:
+            forked = False
+        os._exit(0 if forked else 1)
+
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    assert repo._session is session
+    repo.invalidate()
+    assert repo.get_commit_message() == message
+
+
+def test_cached_properties(repo):
+    first_rev = repo.head_rev
+    first_message = repo.get_commit_message()
+
+    bar = os.path.join(repo.path, "bar")
+    with open(bar, "w") as fh:
+        fh.write("bar")
+    repo.run("add", bar)
+    repo.run("commit", "-m", "Second commit")
+
+    # Changes made through `run` are not picked up until invalidated.
+    assert repo.head_rev == first_rev
+    assert repo.get_commit_message() == first_message
+
+    repo.invalidate()
+    assert repo.head_rev != first_rev
+    assert repo.get_commit_message().strip() == "Second commit"
+
+    repo.update(first_rev)
+    assert repo.head_rev == first_rev
+
+
+def test_instance_cache_bounded(mocker, repo):
+    mocker.patch("taskgraph.util.vcs._INSTANCE_CACHE_SIZE", 2)
+    for revision in (repo.head_rev, repo.head_rev[:12], None):
+        repo.get_commit_message(revision)
+
+    assert list(repo._method_cache) == [
+        ("get_commit_message", (repo.head_rev[:12],), ()),
+        ("get_commit_message", (None,), ()),
+    ]
+
+
+def test_prefetch(repo):
+    repo.prefetch("head_rev", "base_rev", "branch", "default_branch", "remote_name")
+    for name in ("head_rev", "base_rev", "branch", "default_branch"):
+        assert name in repo.__dict__
+
+    # Errors are raised when accessing the property instead.
+    assert "remote_name" not in repo.__dict__
+    with pytest.raises(RuntimeError):
+        repo.remote_name
+
+    with pytest.raises(ValueError):
+        repo.prefetch("all_remote_names")
+
+
+def test_prefetch_parallel(mocker, tmpdir, repo):
+    # Most hg queries go through the single command server instead.
+    if repo.tool == "git":
+        # `get_url` queries the "origin" remote, whereas the current branch
+        # tracks another one.
+        create_remote_repo(tmpdir, repo, "upstream", "remote_repo")
+        create_remote_repo(tmpdir, repo, "origin", "remote_repo2")
+        repo.run("branch", "--set-upstream-to", "upstream/master")
+
+        lock = threading.Lock()
+        running = []
+        max_running = 0
+        run = repo.run
+
+        def slow_run(*args, **kwargs):
+            nonlocal max_running
+            with lock:
+                running.append(args)
+                max_running = max(max_running, len(running))
+            try:
+                time.sleep(0.2)
+                return run(*args, **kwargs)
+            finally:
+                with lock:
+                    running.remove(args)
+
+        spy = mocker.patch.object(repo, "run", side_effect=slow_run)
+        repo.prefetch("head_rev", "branch", "remote_name", "base_rev", "get_url")
+        assert max_running > 1
+
+        # Values shared by several properties are only computed once.
+        rev_parses = [c for c in spy.call_args_list if c.args[0] == "rev-parse"]
+        assert len(rev_parses) == 1
+
+        call_count = spy.call_count
+        assert repo.remote_name == "upstream"
+        assert repo.get_url() == f"{tmpdir}/remote_repo2"
+        repo.base_rev
+        assert spy.call_count == call_count
+
+
 def test_calculate_head_rev(repo):
     if repo.tool == "hg":
         assert repo.head_rev == "c6ef323128f7ba6fd47147743e882d9fc6d72a4e"
@@ -83,6 +269,46 @@ def test_calculate_head_rev(repo):
         assert repo.head_rev == "c34844580592fcf4575b8f1174285b853b566d85"
 
 
+def test_hg_head_rev_no_subprocess(mocker, repo):
+    if repo.tool == "hg":
+        query = mocker.spy(repo, "_query_node")
+        assert repo.head_rev == "c6ef323128f7ba6fd47147743e882d9fc6d72a4e"
+        assert query.call_count == 0
+
+
+def test_hg_remote_names_from_hgrc(mocker, repo):
+    if repo.tool == "hg":
+        with open(os.path.join(repo.path, ".hg/hgrc"), "a") as f:
+            f.write(
+                dedent(
+                    """
+                [paths]
+                upstream = https://some/repo
+                default = https://some.other/repo
+                default:pushurl = ssh://some.other/repo
+                """
+                )
+            )
+
+        run = mocker.spy(repo, "run")
+        assert repo.remote_name == "default"
+        assert run.call_count == 0
+        assert repo.all_remote_names == ["default", "upstream"]
+
+
+def test_hg_remote_names_from_user_config(monkeypatch, tmpdir, repo):
+    if repo.tool == "hg":
+        with open(os.path.join(repo.path, ".hg/hgrc"), "a") as f:
+            f.write("\n[paths]\nupstream = https://some/repo\n")
+        user_hgrc = tmpdir.join("user_hgrc")
+        user_hgrc.write("[paths]\ndefault = https://some.other/repo\n")
+        monkeypatch.setenv("HGRCPATH", user_hgrc.strpath)
+
+        repo = HgRepository(repo.path)
+        assert repo.all_remote_names == ["default", "upstream"]
+        assert repo.remote_name == "default"
+
+
 def test_get_repo_path(repo):
     if repo.tool == "hg":
         with open(os.path.join(repo.path, ".hg/hgrc"), "w") as f:
@@ -111,6 +337,7 @@ def test_update(repo):
     first_rev = repo.head_rev
     repo.run("add", bar)
     repo.run("commit", "-m", "Second commit")
+    repo.invalidate()
 
     second_rev = repo.head_rev
     repo.update(first_rev)
@@ -128,6 +355,7 @@ def test_branch(repo):
         assert repo.branch is None
         repo.run("bookmark", "test")
 
+    repo.invalidate()
     assert repo.branch == "test"
 
     bar = os.path.join(repo.path, "bar")
@@ -136,6 +364,7 @@ def test_branch(repo):
 
     repo.run("add", bar)
     repo.run("commit", "-m", "Second commit")
+    repo.invalidate()
     assert repo.branch == "test"
 
     repo.update(repo.head_rev)
@@ -156,9 +385,59 @@ def test_remote_name(repo_with_remote):
 
     if repo.tool == "git":
         repo.run("branch", "--unset-upstream")
+        repo.invalidate()
+        assert repo.remote_name == remote_name
+
+
+def test_rev_parse_bundle(mocker, repo_with_remote):
+    repo, remote_name = repo_with_remote
+    if repo.tool == "git":
+        run = mocker.spy(repo, "run")
+        assert repo.head_rev == "c34844580592fcf4575b8f1174285b853b566d85"
+        assert repo.branch == "master"
+        assert repo.remote_name == remote_name
+        assert run.call_count == 1
+
+
+def test_git_branch_same_name_as_tag(repo_with_remote):
+    repo, remote_name = repo_with_remote
+    if repo.tool == "git":
+        repo.run("tag", "master")
+        repo.run("checkout", "-b", "feature/x")
+        repo.run("tag", "feature/x")
+        assert repo.branch == "feature/x"
+
+        repo.run("checkout", "master")
+        repo.invalidate()
+        assert repo.branch == "master"
         assert repo.remote_name == remote_name
 
 
+def test_git_no_commit(tmpdir):
+    subprocess.check_output(["git", "init", "-b", "main"], cwd=tmpdir.strpath)
+    repo = GitRepository(tmpdir.strpath)
+
+    assert repo._rev_parse_bundle == (None, None, None)
+    assert repo.branch == "main"
+    with pytest.raises(subprocess.CalledProcessError):
+        repo.head_rev
+
+
+def test_base_rev(repo_with_remote):
+    repo, _ = repo_with_remote
+    expected_base_rev = repo.head_rev
+
+    for name in ("bar", "baz"):
+        with open(os.path.join(repo.path, name), "w") as fh:
+            fh.write(name)
+        repo.run("add", name)
+        repo.run("commit", "-m", f"Add {name}")
+
+    repo.invalidate()
+    assert repo.head_rev != expected_base_rev
+    assert repo.base_rev == expected_base_rev
+
+
 def test_all_remote_names(tmpdir, repo_with_remote):
     repo, remote_name = repo_with_remote
     assert repo.all_remote_names == [remote_name]
@@ -173,6 +452,7 @@ def test_remote_name_many_remotes(tmpdir, repo_with_remote):
     if repo.tool == "git":
         assert repo.remote_name == "upstream2"  # Branch is set to an upstream one
         repo.run("branch", "--unset-upstream")
+        repo.invalidate()
 
     assert repo.remote_name == "upstream"
 
@@ -203,6 +483,20 @@ def test_default_branch_remote_query(repo_with_remote):
         assert repo.default_branch == "default"
 
 
+@pytest.mark.parametrize(
+    "output",
+    (
+        "ref: refs/heads/main\tHEAD\nc34844580592fcf4575b8f1174285b853b566d85\tHEAD\n",
+        "some capability line\nref: refs/heads/main\tHEAD\n",
+    ),
+)
+def test_default_branch_remote_query_output(mocker, git_repo, output):
+    repo = GitRepository(git_repo)
+    repo.__dict__["remote_name"] = "upstream"
+    mocker.patch.object(repo, "run", return_value=output)
+    assert repo._get_default_branch_from_remote_query() == "upstream/main"
+
+
 def test_default_branch_cloned_metadata(tmpdir, repo):
     if repo.tool == "git":
         clone_repo_path = tmpdir / "cloned_repo"
@@ -212,6 +506,19 @@ def test_default_branch_cloned_metadata(tmpdir, repo):
         assert cloned_repo.default_branch == "origin/master"
 
 
+def test_default_branch_cloned_metadata_no_subprocess(mocker, tmpdir, repo):
+    if repo.tool == "git":
+        clone_repo_path = tmpdir / "cloned_repo"
+        command = ("git", "clone", repo.path, clone_repo_path)
+        subprocess.check_output(command, cwd=tmpdir)
+        cloned_repo = get_repository(clone_repo_path)
+        cloned_repo.remote_name
+
+        run = mocker.spy(cloned_repo, "run")
+        assert cloned_repo.default_branch == "origin/master"
+        assert run.call_count == 0
+
+
 def assert_files(actual, expected):
     assert set(map(os.path.basename, actual)) == set(expected)
 
@@ -412,6 +719,7 @@ def test_find_latest_common_revision(repo_with_remote):
 
     repo.run("add", ".")
     repo.run("commit", "-m", "Add new revision")
+    repo.invalidate()
 
     assert repo.head_rev != expected_latest_common_revision
 
@@ -439,8 +747,144 @@ def test_does_revision_exist_locally(repo):
 
     repo.run("add", ".")
     repo.run("commit", "-m", "Add new revision")
+    repo.invalidate()
 
     last_revision = repo.head_rev
     assert repo.does_revision_exist_locally(first_revision)
     assert repo.does_revision_exist_locally(last_revision)
     assert not repo.does_revision_exist_locally("deadbeef")
+
+
+def test_does_revision_exist_locally_whitespace(repo):
+    if repo.tool == "git":
+        assert not repo.does_revision_exist_locally("bad rev")
+        assert not repo.does_revision_exist_locally(f"bad\n{repo.head_rev}")
+        # Later lookups are still answered by the same helper process.
+        assert repo.does_revision_exist_locally(repo.head_rev)
+        assert repo.get_commit_message().strip() == "First commit"
+
+
+def test_find_hg_revision_push_info(responses):
+    repository = "https://hg.mozilla.org/mozilla-central"
+    revision = "abcdef"
+    responses.add(
+        responses.GET,
+        f"{repository}/json-pushes?version=2&changeset={revision}&tipsonly=1&full=1",
+        json={
+            "lastpushid": 2,
+            "pushes": {"2": {"changesets": [], "date": 1234, "user": "someone"}},
+        },
+    )
+
+    assert find_hg_revision_push_info(repository, revision) == {
+        "pushdate": 1234,
+        "pushid": "2",
+        "user": "someone",
+    }
+
+
+def test_find_hg_revision_push_info_cache(mocker, monkeypatch, responses, tmpdir):
+    monkeypatch.delenv("TASKGRAPH_DISABLE_PUSHLOG_CACHE", raising=False)
+    mocker.patch("taskgraph.util.vcs._pushlog_cache_dir", return_value=str(tmpdir))
+
+    repository = "https://hg.mozilla.org/mozilla-central"
+    revision = "a" * 40
+    responses.add(
+        responses.GET,
+        f"{repository}/json-pushes?version=2&changeset={revision}&tipsonly=1&full=1",
+        json={
+            "lastpushid": 2,
+            "pushes": {"2": {"changesets": [], "date": 1234, "user": "someone"}},
+        },
+    )
+    expected = {"pushdate": 1234, "pushid": "2", "user": "someone"}
+
+    assert find_hg_revision_push_info(repository, revision) == expected
+    assert len(tmpdir.listdir()) == 1
+
+    # The second lookup is served from the cache.
+    assert find_hg_revision_push_info(repository, revision) == expected
+    assert len(responses.calls) == 1
+
+    monkeypatch.setenv("TASKGRAPH_DISABLE_PUSHLOG_CACHE", "1")
+    assert find_hg_revision_push_info(repository, revision) == expected
+    assert len(responses.calls) == 2
+
+
+def test_find_hg_revision_push_info_retry(mocker, responses):
+    sleep = mocker.patch("taskgraph.util.vcs.time.sleep")
+    repository = "https://hg.mozilla.org/mozilla-central"
+    revision = "abcdef"
+    url = f"{repository}/json-pushes?version=2&changeset={revision}&tipsonly=1&full=1"
+    responses.add(responses.GET, url, status=500)
+    responses.add(responses.GET, url, status=404)
+    responses.add(
+        responses.GET,
+        url,
+        json={
+            "lastpushid": 2,
+            "pushes": {"2": {"changesets": [], "date": 1234, "user": "someone"}},
+        },
+    )
+
+    assert find_hg_revision_push_info(repository, revision)["pushid"] == "2"
+    assert len(responses.calls) == 3
+    assert sleep.call_count == 2
+    # Server errors are retried quickly, whereas missing revisions are given
+    # time to be replicated.
+    assert sleep.call_args_list[0][0][0] < 1
+    assert sleep.call_args_list[1][0][0] >= 15
+
+
+def test_find_hg_revision_push_info_client_error(mocker, responses):
+    sleep = mocker.patch("taskgraph.util.vcs.time.sleep")
+    repository = "https://hg.mozilla.org/mozilla-central"
+    revision = "abcdef"
+    url = f"{repository}/json-pushes?version=2&changeset={revision}&tipsonly=1&full=1"
+    responses.add(responses.GET, url, status=400)
+
+    with pytest.raises(requests.HTTPError):
+        find_hg_revision_push_info(repository, revision)
+    assert len(responses.calls) == 1
+    assert sleep.call_count == 0
+
+
+def test_find_hg_revision_push_info_batch(mocker, monkeypatch, responses):
+    monkeypatch.setenv("TASKGRAPH_DISABLE_PUSHLOG_CACHE", "1")
+    mocker.patch("taskgraph.util.vcs.PUSHLOG_BATCH_SIZE", 2)
+
+    repository = "https://hg.mozilla.org/mozilla-central"
+    aaa, bbb, ccc = "a" * 12, "B" * 12, "c" * 12
+    responses.add(
+        responses.GET,
+        f"{repository}/json-pushes?version=2&changeset={aaa}&changeset={bbb}",
+        json={
+            "lastpushid": 3,
+            "pushes": {
+                "2": {
+                    "changesets": ["a" * 40, "b" * 40],
+                    "date": 1,
+                    "user": "a",
+                },
+            },
+        },
+    )
+    for revision, pushid in ((ccc, "3"), ("some-tag", "4")):
+        responses.add(
+            responses.GET,
+            f"{repository}/json-pushes?version=2&changeset={revision}&tipsonly=1&full=1",
+            json={
+                "lastpushid": 4,
+                "pushes": {pushid: {"changesets": [], "date": 2, "user": "b"}},
+            },
+        )
+
+    assert find_hg_revision_push_info_batch(
+        repository, [aaa, bbb, "some-tag", ccc]
+    ) == {
+        aaa: {"pushdate": 1, "pushid": "2", "user": "a"},
+        bbb: {"pushdate": 1, "pushid": "2", "user": "a"},
+        ccc: {"pushdate": 2, "pushid": "3", "user": "b"},
+        "some-tag": {"pushdate": 2, "pushid": "4", "user": "b"},
+    }
+    assert len(responses.calls) == 3